@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Benchmark in-process intent classification overhead under concurrent load.
+
+Drives ``IntentClassifier.classify`` at a fixed request rate from many threads
+and reports per-request latency percentiles and the realized micro-batch size.
+
+    python benchmarks/bench_intent.py --rate 500 --duration 10
+    INTENT_MODEL_URI=runs:/<run_id>/model python benchmarks/bench_intent.py
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+
+from app import IntentClassifier  # noqa: E402
+
+
+def build_classifier(max_batch: int, max_wait: float) -> IntentClassifier:
+    model_uri = os.getenv("INTENT_MODEL_URI")
+    if model_uri:
+        return IntentClassifier.from_uri(
+            model_uri, max_batch=max_batch, max_wait=max_wait, timeout=1.0
+        )
+
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+
+    data = pd.concat(
+        pd.read_csv(path) for path in sorted((ROOT / "ml" / "data").glob("*.csv"))
+    )
+    pipeline = Pipeline(
+        [
+            ("tfidf", TfidfVectorizer(max_features=30_000, ngram_range=(1, 2))),
+            ("clf", LogisticRegression(max_iter=200)),
+        ]
+    ).fit(data["text"].astype(str), data["label"].astype(str))
+    return IntentClassifier(
+        model=pipeline, max_batch=max_batch, max_wait=max_wait, timeout=1.0
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=500, help="requests/second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=0.0)
+    parser.add_argument("--budget_ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    classifier = build_classifier(args.max_batch, args.max_wait_ms / 1000)
+    texts = pd.read_csv(ROOT / "ml" / "data" / "intent_autosample_v2.csv")[
+        "text"
+    ].tolist()
+    classifier.classify(texts[0])  # warm up the batcher thread
+
+    total = int(args.rate * args.duration)
+    interval = args.threads / args.rate
+    latencies = np.zeros(total)
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def worker(offset: int) -> None:
+        next_at = time.perf_counter() + offset * interval / args.threads
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+            started = time.perf_counter()
+            classifier.classify(texts[index % len(texts)])
+            latencies[index] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    stats = classifier.stats()
+    print(f"requests:        {total} in {elapsed:.2f}s ({total / elapsed:.0f} req/s)")
+    print(f"latency ms:      p50={p50:.3f} p95={p95:.3f} p99={p99:.3f}")
+    print(f"avg batch size:  {stats['avg_batch_size']}  timeouts: {stats['timeouts']}")
+    if p50 > args.budget_ms:
+        print(f"FAIL: p50 {p50:.3f} ms exceeds budget {args.budget_ms} ms")
+        sys.exit(1)
+    print(f"OK: p50 within {args.budget_ms} ms budget")
+
+
+if __name__ == "__main__":
+    main()
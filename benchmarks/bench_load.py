@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""End-to-end load test of /api/chat and /api/chat/stream through gunicorn.
+
+Starts the fake DeepSeek server and ``gunicorn -c gunicorn.conf.py app:app``
+against it, then runs closed-loop clients at increasing concurrency levels. For
+each route and level it reports throughput, p50/p95/p99 latency, time to first
+byte and worker RSS per open connection. Results are written as JSON; pass
+``--baseline`` to compare against an earlier run (exit code 1 on regression).
+
+    python benchmarks/bench_load.py --levels 1,16,64,256 --duration 10
+    python benchmarks/bench_load.py --output new.json --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from fake_deepseek import FakeConfig, FakeDeepSeekServer  # noqa: E402
+
+ROUTES = {"chat": "/api/chat", "stream": "/api/chat/stream"}
+# 比较基线时：吞吐量越低越差，其余指标越高越差
+HIGHER_IS_BETTER = {"throughput_rps"}
+COMPARED = ["throughput_rps", "latency_p50_ms", "latency_p99_ms", "ttfb_p50_ms"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def rss_kb(pid: int) -> int:
+    """RSS of a process and its direct children (gunicorn master + workers)."""
+    total = 0
+    pids = [pid]
+    try:
+        children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+        pids += [int(child) for child in children]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            for line in Path(f"/proc/{p}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+def start_gunicorn(
+    port: int, upstream: str, workers: int, worker_class: Optional[str]
+) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "WEB_CONCURRENCY": str(workers),
+        "DEEPSEEK_API_BASE_URL": upstream,
+        "DEEPSEEK_API_KEY": os.getenv("DEEPSEEK_API_KEY", "benchmark"),
+        "LOG_LEVEL": "WARNING",
+        # 基准测的是服务本身，不让限流器和缓存掩盖结果
+        "UPSTREAM_CONCURRENCY_INITIAL": "4096",
+        "UPSTREAM_CONCURRENCY_MAX": "4096",
+        "UPSTREAM_QUEUE_TIMEOUT": "60",
+        "RESPONSE_CACHE_SIZE": "0",
+    }
+    if worker_class:
+        env["GUNICORN_WORKER_CLASS"] = worker_class
+        env.setdefault("GUNICORN_THREADS", "64")
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT,
+        env=env,
+    )
+
+
+def wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/api/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not become ready")
+
+
+async def one_request(
+    client: httpx.AsyncClient, path: str, message: str
+) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttfb = None
+    async with client.stream("POST", path, json={"message": message}) as response:
+        async for _ in response.aiter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+        ok = response.status_code == 200
+    elapsed = time.perf_counter() - started
+    return {"ok": ok, "latency": elapsed, "ttfb": ttfb if ttfb is not None else elapsed}
+
+
+async def run_level(
+    base_url: str, mode: str, concurrency: int, duration: float, pid: Optional[int]
+) -> Dict[str, Any]:
+    path = ROUTES[mode]
+    counter = itertools.count()
+    samples: List[Dict[str, Any]] = []
+    errors = 0
+    peak_rss = 0
+    idle_rss = rss_kb(pid) if pid else 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    timeout = httpx.Timeout(120.0)
+
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=timeout
+    ) as client:
+
+        async def worker() -> None:
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                # 每个请求的问题都不同，避免缓存与请求合并
+                message = f"benchmark question {next(counter)}"
+                try:
+                    result = await one_request(client, path, message)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                if result["ok"]:
+                    samples.append(result)
+                else:
+                    errors += 1
+
+        async def sample_memory() -> None:
+            nonlocal peak_rss
+            while time.perf_counter() < deadline:
+                peak_rss = max(peak_rss, rss_kb(pid)) if pid else 0
+                await asyncio.sleep(0.2)
+
+        started = time.perf_counter()
+        await asyncio.gather(sample_memory(), *(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies = np.array([s["latency"] for s in samples] or [0.0]) * 1000
+    ttfbs = np.array([s["ttfb"] for s in samples] or [0.0]) * 1000
+    lp50, lp95, lp99 = np.percentile(latencies, [50, 95, 99])
+    tp50, tp95, tp99 = np.percentile(ttfbs, [50, 95, 99])
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "latency_p50_ms": round(float(lp50), 2),
+        "latency_p95_ms": round(float(lp95), 2),
+        "latency_p99_ms": round(float(lp99), 2),
+        "ttfb_p50_ms": round(float(tp50), 2),
+        "ttfb_p95_ms": round(float(tp95), 2),
+        "ttfb_p99_ms": round(float(tp99), 2),
+        "rss_peak_mb": round(peak_rss / 1024, 1),
+        "rss_per_connection_kb": round(max(peak_rss - idle_rss, 0) / concurrency, 1),
+    }
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Return a description of every metric worse than baseline by > tolerance."""
+    previous = {(r["mode"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for row in results:
+        base = previous.get((row["mode"], row["concurrency"]))
+        if base is None:
+            continue
+        for metric in COMPARED:
+            old, new = base[metric], row[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append(
+                    f"{row['mode']}@{row['concurrency']} {metric}: "
+                    f"{old} -> {new} ({change:+.1%})"
+                )
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    header = (
+        f"{'mode':<7}{'conc':>6}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+        f"{'ttfb50':>9}{'ttfb99':>9}{'err':>6}{'KB/conn':>9}"
+    )
+    print(header)
+    for r in results:
+        print(
+            f"{r['mode']:<7}{r['concurrency']:>6}{r['throughput_rps']:>9.1f}"
+            f"{r['latency_p50_ms']:>9.1f}{r['latency_p95_ms']:>9.1f}"
+            f"{r['latency_p99_ms']:>9.1f}{r['ttfb_p50_ms']:>9.1f}"
+            f"{r['ttfb_p99_ms']:>9.1f}{r['errors']:>6}"
+            f"{r['rss_per_connection_kb']:>9.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", default="1,16,64,256")
+    parser.add_argument("--modes", default="chat,stream")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--worker-class", default=None, help="override gunicorn.conf.py (gevent)"
+    )
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=100.0)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--abort-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--target", default=None, help="benchmark an already running server"
+    )
+    parser.add_argument("--output", default="bench_load.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        abort_rate=args.abort_rate,
+    )
+    fake = None
+    server = None
+    base_url = args.target
+    if base_url is None:
+        fake = FakeDeepSeekServer(config=config).start_in_thread()
+        port = free_port()
+        server = start_gunicorn(port, fake.base_url, args.workers, args.worker_class)
+        base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_ready(base_url)
+        # 预热：让各 worker 完成惰性初始化，避免计入第一档的内存与延迟
+        for mode in args.modes.split(","):
+            asyncio.run(run_level(base_url, mode, args.workers * 2, 0.5, None))
+        results = []
+        for mode in args.modes.split(","):
+            for level in (int(n) for n in args.levels.split(",")):
+                row = asyncio.run(
+                    run_level(
+                        base_url,
+                        mode,
+                        level,
+                        args.duration,
+                        server.pid if server else None,
+                    )
+                )
+                results.append(row)
+                print(
+                    f"{mode}@{level}: {row['throughput_rps']} req/s, "
+                    f"p99 {row['latency_p99_ms']} ms, {row['errors']} errors",
+                    flush=True,
+                )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if fake is not None:
+            fake.stop()
+
+    print()
+    print_table(results)
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "workers": args.workers,
+            "worker_class": args.worker_class or "gevent",
+            "duration": args.duration,
+            "fake_upstream": vars(config),
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nregressions vs {args.baseline} (> {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"no regressions vs {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Benchmark ``SemanticCache.get`` latency against a large index.
+
+Fills one generation-parameter bucket with ``--entries`` distinct synthetic
+questions (mixed Chinese/English, character n-gram TF-IDF as exported by
+``ml/train.py --export_vectorizer``), then times lookups for paraphrases of
+cached questions (hits) and unrelated questions (misses). Two write-heavy
+passes follow: the serving pattern of ``get`` then ``add`` on a miss, and
+lookups while another thread keeps adding new questions (block merges must
+not stall readers). The target is a get p99 below ``--budget_ms`` (1 ms) at
+100k entries in every pass.
+
+    python benchmarks/bench_semantic_cache.py --entries 100000 --queries 2000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "ml"))
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+
+from app import SemanticCache  # noqa: E402
+from train import SEMANTIC_CACHE_PARAMS  # noqa: E402
+
+TEMPLATES = [
+    "什么是{}？通俗解释一下",
+    "零基础如何学习{}？",
+    "请给出{}的示例代码",
+    "使用{}时报错怎么办？",
+    "Explain what {} is",
+    "How to fix an error with {}",
+    "Show an example of {} in python",
+    "Best books to learn {}",
+]
+# CJK block and lowercase ASCII to build pseudo-words for distinct topics
+HANZI = np.array([chr(c) for c in range(0x4E00, 0x4E00 + 3000)])
+LETTERS = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+
+
+def questions(rng: np.random.Generator, count: int) -> list:
+    """``count`` questions with random 2-4 character topics and a detail clause."""
+    texts = []
+    for index in range(count):
+        template = TEMPLATES[index % len(TEMPLATES)]
+        alphabet = HANZI if "{}" in template and ord(template[0]) > 127 else LETTERS
+        topic = "".join(rng.choice(alphabet, rng.integers(2, 5)))
+        detail = "".join(rng.choice(alphabet, rng.integers(4, 9)))
+        texts.append(f"{template.format(topic)} {detail}")
+    return texts
+
+
+def percentiles(samples: np.ndarray) -> str:
+    p50, p99 = np.percentile(samples * 1000, [50, 99])
+    return f"p50 {p50:.3f} ms  p99 {p99:.3f} ms  mean {samples.mean() * 1000:.3f} ms"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2_000)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--budget_ms", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--write_rate",
+        type=float,
+        default=200,
+        help="adds per second of the concurrent writer (each add is one upstream answer)",
+    )
+    args = parser.parse_args()
+
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    rng = np.random.default_rng(args.seed)
+    texts = questions(rng, args.entries)
+    started = time.perf_counter()
+    vectorizer = TfidfVectorizer(**SEMANTIC_CACHE_PARAMS).fit(texts)
+    cache = SemanticCache(
+        vectorizer=vectorizer,
+        threshold=args.threshold,
+        max_entries=args.entries,
+    )
+    params = (2048, 0.7, "deepseek-chat")
+    for index, text in enumerate(texts):
+        cache.add(text, params, {"reply": index})
+    print(
+        f"indexed {cache.stats()['entries']} entries "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+    picks = rng.integers(0, len(texts), args.queries)
+    suffixes = [" 请详细一些", " please", "？", " 给个例子"]
+    paraphrases = [texts[i] + suffixes[i % len(suffixes)] for i in picks]
+    unrelated = questions(np.random.default_rng(args.seed + 1), args.queries)
+    for text in paraphrases[:50]:
+        cache.get(text, params)  # warm up
+
+    results = {}
+    for name, batch in (("hit", paraphrases), ("miss", unrelated)):
+        latencies = np.zeros(len(batch))
+        found = 0
+        for index, text in enumerate(batch):
+            began = time.perf_counter()
+            found += cache.get(text, params) is not None
+            latencies[index] = time.perf_counter() - began
+        results[name] = latencies
+        print(f"{name:>12}: {percentiles(latencies)}  found {found}/{len(batch)}")
+
+    # serving pattern: look up, and on a miss answer upstream and add the answer
+    fresh = questions(np.random.default_rng(args.seed + 2), args.queries)
+    mixed = [text for pair in zip(paraphrases, fresh) for text in pair]
+    gets, adds = np.zeros(len(mixed)), []
+    for index, text in enumerate(mixed):
+        began = time.perf_counter()
+        hit = cache.get(text, params)
+        gets[index] = time.perf_counter() - began
+        if hit is None:
+            began = time.perf_counter()
+            cache.add(text, params, {"reply": text})
+            adds.append(time.perf_counter() - began)
+    results["get+add"] = gets
+    print(f"{'get+add':>12}: {percentiles(gets)}  max {gets.max() * 1000:.3f} ms")
+    adds = np.array(adds)
+    print(
+        f"{'add':>12}: {percentiles(adds)}  max {adds.max() * 1000:.3f} ms  "
+        f"({len(adds)} adds)"
+    )
+
+    # lookups while a writer thread keeps adding (merges run outside the lock);
+    # the GIL is still shared, so an unthrottled writer measures that instead
+    stop = threading.Event()
+    writes = questions(np.random.default_rng(args.seed + 3), args.entries)
+
+    def writer() -> None:
+        for index, text in enumerate(writes):
+            if stop.wait(1 / args.write_rate):
+                break
+            cache.add(text, params, {"reply": index})
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    latencies = np.zeros(len(paraphrases))
+    for index, text in enumerate(paraphrases):
+        began = time.perf_counter()
+        cache.get(text, params)
+        latencies[index] = time.perf_counter() - began
+    stop.set()
+    thread.join()
+    results["concurrent"] = latencies
+    print(
+        f"{'concurrent':>12}: {percentiles(latencies)}  "
+        f"max {latencies.max() * 1000:.3f} ms  entries {cache.stats()['entries']}"
+    )
+
+    p99 = max(np.percentile(latencies, 99) for latencies in results.values()) * 1000
+    verdict = "within" if p99 <= args.budget_ms else "OVER"
+    print(f"p99 {p99:.3f} ms is {verdict} the {args.budget_ms} ms budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Benchmark out-of-core intent training (``ml/train.py --streaming``) on large data.
+
+Generates synthetic Parquet datasets of increasing size with NumPy, then trains
+each one in a fresh process and reports wall time, throughput, holdout accuracy
+and peak RSS. With streaming training peak RSS should stay flat as rows grow;
+``--in-memory-max`` also runs the TF-IDF path up to that size for comparison.
+
+    python benchmarks/bench_train.py --sizes 100000,300000,1000000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "ml"))
+
+from train import DEFAULT_LABELS  # noqa: E402
+
+TOPICS = [
+    "交叉熵",
+    "过拟合",
+    "梯度下降",
+    "Transformer",
+    "SVM",
+    "CUDA",
+    "PyTorch",
+    "pandas",
+    "numpy",
+    "逻辑回归",
+]
+TEMPLATES = {
+    "概念解释": ["什么是{}？通俗解释一下", "Explain what {} is"],
+    "学习路径建议": ["零基础如何学习{}？", "How to learn {} step by step"],
+    "示例代码": ["请给出{}的示例代码", "Show an example of {} in python"],
+    "报错排查": ["使用{}时报错怎么办？", "How to fix an error with {}"],
+    "工具安装配置": ["如何安装配置{}？", "How to install {} on Ubuntu"],
+    "作业/考试题解读": ["这道关于{}的题该如何下手？", "How to solve this {} exam question"],
+    "复习总结/要点": ["帮我总结{}的核心要点", "Key takeaways of {}"],
+    "资料推荐": ["推荐学习{}的资料", "Best books to learn {}"],
+}
+
+# the in-memory path is only the reference, keep it to a size that fits
+IN_MEMORY_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {ml!r})
+import pandas as pd
+import train
+frame = pd.read_parquet({path!r}, columns=["text", "label"])
+started = time.perf_counter()
+train.train_and_log(frame, "bench-train", "in-memory", max_iter=100, cache_dir=None)
+print(json.dumps({{"train_seconds": time.perf_counter() - started,
+                  "peak_rss_mb": train.peak_rss_mb()}}, indent=2))
+"""
+
+
+def generate(path: Path, rows: int, block: int = 100_000, seed: int = 0) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(seed)
+    labels = np.array(DEFAULT_LABELS)
+    # split each template around "{}" so rows are built with array ops
+    parts = [[t.split("{}") for t in TEMPLATES[label]] for label in DEFAULT_LABELS]
+    prefixes = np.array([[p[0] for p in row] for row in parts])
+    suffixes = np.array([[p[1] for p in row] for row in parts])
+    topics = np.array(TOPICS)
+    with pq.ParquetWriter(
+        path, pa.schema([("text", pa.string()), ("label", pa.string())])
+    ) as writer:
+        for start in range(0, rows, block):
+            n = min(block, rows - start)
+            label_idx = rng.integers(0, len(labels), n)
+            template_idx = rng.integers(0, prefixes.shape[1], n)
+            topic = topics[rng.integers(0, len(topics), n)]
+            # a random chapter number keeps rows distinct across the hash holdout
+            chapter = np.char.add(" 第", rng.integers(1, 50, n).astype(str))
+            text = np.char.add(
+                np.char.add(prefixes[label_idx, template_idx], topic),
+                np.char.add(suffixes[label_idx, template_idx], chapter),
+            )
+            writer.write_table(
+                pa.table({"text": text.tolist(), "label": labels[label_idx].tolist()})
+            )
+
+
+def run(command: List[str], workdir: Path) -> Dict[str, Any]:
+    # run inside workdir so mlflow's default ./mlruns artifacts land there too
+    env = {**os.environ, "MLFLOW_TRACKING_URI": f"sqlite:///{workdir / 'mlflow.db'}"}
+    started = time.perf_counter()
+    result = subprocess.run(
+        command, cwd=workdir, env=env, capture_output=True, text=True, check=True
+    )
+    elapsed = time.perf_counter() - started
+    # the metrics are the JSON block printed last; mlflow may log around it
+    lines = result.stdout.splitlines()
+    start = max(i for i, line in enumerate(lines) if line.startswith("{"))
+    end = next(i for i in range(start, len(lines)) if lines[i].startswith("}"))
+    metrics = json.loads("\n".join(lines[start : end + 1]))
+    metrics["wall_seconds"] = elapsed
+    return metrics
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100000,300000,1000000")
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--n-features", type=int, default=2**20)
+    parser.add_argument("--in-memory-max", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="keep generated data here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir or tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        print(
+            f"{'rows':>9}{'mode':>11}{'seconds':>9}{'rows/s':>10}{'acc':>7}{'rss MB':>9}"
+        )
+        for rows in (int(n) for n in args.sizes.split(",")):
+            path = workdir / f"intent_{rows}.parquet"
+            if not path.exists():
+                generate(path, rows)
+            metrics = run(
+                [
+                    sys.executable,
+                    str(ROOT / "ml" / "train.py"),
+                    "--data",
+                    str(path),
+                    "--exp",
+                    "bench-train",
+                    "--streaming",
+                    "--chunk_size",
+                    str(args.chunk_size),
+                    "--n_features",
+                    str(args.n_features),
+                ],
+                workdir,
+            )
+            seconds = metrics["train_seconds"]
+            print(
+                f"{rows:>9}{'streaming':>11}{seconds:>9.1f}{rows / seconds:>10.0f}"
+                f"{metrics['accuracy']:>7.3f}{metrics['peak_rss_mb']:>9.0f}",
+                flush=True,
+            )
+            if rows <= args.in_memory_max:
+                script = IN_MEMORY_SCRIPT.format(ml=str(ROOT / "ml"), path=str(path))
+                metrics = run([sys.executable, "-c", script], workdir)
+                seconds = metrics["train_seconds"]
+                print(
+                    f"{rows:>9}{'in-memory':>11}{seconds:>9.1f}"
+                    f"{rows / seconds:>10.0f}{'':>7}{metrics['peak_rss_mb']:>9.0f}",
+                    flush=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Benchmark concurrent upstream streams through DeepSeekClient's pooled async path.
+
+Starts a local fake DeepSeek server (or targets ``--base-url``), opens
+``--concurrency`` simultaneous streaming completions and reports time to first
+token, completion throughput and the peak number of streams the server saw.
+
+    python benchmarks/bench_upstream.py --concurrency 2000 --tokens 16
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from fake_deepseek import FakeConfig, FakeDeepSeekServer  # noqa: E402
+
+
+async def one_stream(client, ttfts, errors) -> None:
+    started = time.perf_counter()
+    first = None
+    try:
+        async for _ in client.achat_completion_stream("benchmark", max_tokens=64):
+            if first is None:
+                first = time.perf_counter() - started
+    except Exception as exc:  # noqa: BLE001 - counted and reported
+        errors.append(str(exc))
+        return
+    ttfts.append(first or 0.0)
+
+
+async def run(concurrency: int) -> None:
+    from app import DeepSeekClient
+
+    client = DeepSeekClient()
+    ttfts: list = []
+    errors: list = []
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(one_stream(client, ttfts, errors) for _ in range(concurrency))
+    )
+    elapsed = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    await client.aclose()
+
+    print(f"streams:        {len(ttfts)} ok, {len(errors)} failed in {elapsed:.2f}s")
+    if ttfts:
+        p50, p99 = np.percentile(np.array(ttfts) * 1000, [50, 99])
+        print(f"ttft ms:        p50={p50:.1f} p99={p99:.1f}")
+    print(f"streams/s:      {len(ttfts) / elapsed:.0f}")
+    print(f"peak rss delta: {(rss_after - rss_before) / 1024:.1f} MiB")
+    if errors:
+        print(f"first error:    {errors[0]}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=16)
+    parser.add_argument("--base-url", default=None, help="use an external server")
+    args = parser.parse_args()
+
+    server = None
+    if args.base_url is None:
+        server = FakeDeepSeekServer(
+            config=FakeConfig(args.latency, args.token_rate, args.tokens)
+        ).start_in_thread()
+        args.base_url = server.base_url
+    os.environ["DEEPSEEK_API_BASE_URL"] = args.base_url
+    os.environ.setdefault("DEEPSEEK_API_KEY", "benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("DEEPSEEK_MAX_CONNECTIONS", str(args.concurrency))
+
+    asyncio.run(run(args.concurrency))
+    if server is not None:
+        print(f"server peak:    {server.peak_streams} concurrent streams")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Local OpenAI-compatible stub of the DeepSeek chat API for benchmarks.
+
+Implements ``POST .../chat/completions`` (streaming and non-streaming) on a
+minimal asyncio HTTP/1.1 server with keep-alive, so thousands of concurrent
+streams cost one coroutine each instead of one thread each. ``--error-rate``
+answers that fraction of requests with ``--error-status``; ``--abort-rate``
+cuts that fraction of streams off after the first token.
+
+    python benchmarks/fake_deepseek.py --port 9100 --latency 0.2 --token-rate 50
+    DEEPSEEK_API_BASE_URL=http://127.0.0.1:9100 DEEPSEEK_API_KEY=fake python app.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.1  # seconds before the first token / full response
+    token_rate: float = 100.0  # streamed tokens per second (0 = unthrottled)
+    tokens: int = 64  # completion tokens per response
+    error_rate: float = 0.0  # fraction of requests answered with error_status
+    error_status: int = 500
+    abort_rate: float = 0.0  # fraction of streams dropped after the first token
+
+
+def _completion_body(config: FakeConfig, model: str) -> Dict[str, Any]:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "tok " * config.tokens},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": _usage(config),
+    }
+
+
+def _usage(config: FakeConfig) -> Dict[str, int]:
+    return {
+        "prompt_tokens": 16,
+        "completion_tokens": config.tokens,
+        "total_tokens": 16 + config.tokens,
+        # DeepSeek-style prefix cache accounting (the fake never has a cache hit)
+        "prompt_cache_hit_tokens": 0,
+        "prompt_cache_miss_tokens": 16,
+    }
+
+
+def _error_body(config: FakeConfig) -> bytes:
+    error = {"message": "injected error", "type": "fake_error"}
+    if config.error_status == 429:
+        error["type"] = "rate_limit_exceeded"
+    return json.dumps({"error": error}).encode()
+
+
+def _usage_chunk(config: FakeConfig, model: str) -> bytes:
+    payload = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [],
+        "usage": _usage(config),
+    }
+    return b"data: " + json.dumps(payload).encode() + b"\n\n"
+
+
+def _chunk(model: str, delta: Dict[str, str], finish: Optional[str] = None) -> bytes:
+    payload = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return b"data: " + json.dumps(payload).encode() + b"\n\n"
+
+
+class FakeDeepSeekServer:
+    """asyncio server; ``start_in_thread`` runs it next to a benchmark client."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        config: Optional[FakeConfig] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.config = config or FakeConfig()
+        self.active_streams = 0
+        self.peak_streams = 0
+        self.requests = 0
+        self.errors = 0
+        self.aborts = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def serve(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, backlog=4096
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self) -> "FakeDeepSeekServer":
+        ready = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            task = self._loop.create_task(self.serve())
+            self._loop.call_soon(ready.set)
+            try:
+                self._loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+
+        threading.Thread(target=run, name="fake-deepseek", daemon=True).start()
+        ready.wait()
+        while self._server is None or not self._server.sockets:
+            time.sleep(0.01)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self) -> None:
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        method, path, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, headers, body
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                self.requests += 1
+                if method != "POST" or not path.rstrip("/").endswith(
+                    "/chat/completions"
+                ):
+                    await self._respond(writer, 404, b'{"error": "not found"}')
+                elif random.random() < self.config.error_rate:
+                    self.errors += 1
+                    await asyncio.sleep(self.config.latency)
+                    await self._respond(
+                        writer, self.config.error_status, _error_body(self.config)
+                    )
+                else:
+                    payload = json.loads(body or b"{}")
+                    if payload.get("stream"):
+                        include_usage = (payload.get("stream_options") or {}).get(
+                            "include_usage", False
+                        )
+                        if not await self._stream(
+                            writer, payload.get("model", "fake"), include_usage
+                        ):
+                            break
+                    else:
+                        await asyncio.sleep(self.config.latency + self._gen_time())
+                        data = _completion_body(self.config, payload.get("model", ""))
+                        await self._respond(writer, 200, json.dumps(data).encode())
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _gen_time(self) -> float:
+        rate = self.config.token_rate
+        return self.config.tokens / rate if rate > 0 else 0.0
+
+    async def _respond(
+        self, writer: asyncio.StreamWriter, status: int, body: bytes
+    ) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _stream(
+        self, writer: asyncio.StreamWriter, model: str, include_usage: bool
+    ) -> bool:
+        """Stream one completion; returns False if the connection was aborted."""
+        self.active_streams += 1
+        self.peak_streams = max(self.peak_streams, self.active_streams)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n"
+                b"Connection: keep-alive\r\n\r\n"
+            )
+            await asyncio.sleep(self.config.latency)
+            interval = 1 / self.config.token_rate if self.config.token_rate > 0 else 0
+            chunks = [_chunk(model, {"role": "assistant", "content": ""})]
+            chunks += [_chunk(model, {"content": "tok "})] * self.config.tokens
+            chunks.append(_chunk(model, {}, "stop"))
+            if include_usage:
+                chunks.append(_usage_chunk(self.config, model))
+            chunks.append(b"data: [DONE]\n\n")
+            abort = random.random() < self.config.abort_rate
+            for i, chunk in enumerate(chunks):
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+                if abort and i == 1:
+                    self.aborts += 1
+                    return False
+                if interval:
+                    await asyncio.sleep(interval)
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return True
+        finally:
+            self.active_streams -= 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--token-rate", type=float, default=100.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--abort-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeDeepSeekServer(
+        args.host,
+        args.port,
+        FakeConfig(
+            latency=args.latency,
+            token_rate=args.token_rate,
+            tokens=args.tokens,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            abort_rate=args.abort_rate,
+        ),
+    )
+    print(f"Fake DeepSeek listening on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
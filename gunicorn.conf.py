@@ -0,0 +1,41 @@
+"""Gunicorn 配置（Dockerfile 默认使用：gunicorn -c gunicorn.conf.py app:app）"""
+
+import gc
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8888')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+# 仅 gthread worker 使用
+threads = int(os.getenv("GUNICORN_THREADS", 1))
+# 每个 gevent worker 可同时挂起的连接（含 SSE 长连接）上限
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 2000))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+# 在 master 中导入应用并预热只读依赖，worker fork 后写时复制共享，启动更快、占用更少内存
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Prometheus 多进程模式：worker 把指标写入共享目录（目录由 app 导入时创建），
+# 启动时清掉上次运行残留的文件
+prometheus_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if prometheus_multiproc_dir and os.path.isdir(prometheus_multiproc_dir):
+    for name in os.listdir(prometheus_multiproc_dir):
+        if name.endswith(".db"):
+            os.remove(os.path.join(prometheus_multiproc_dir, name))
+
+
+def when_ready(server):
+    """preload 时应用已在 master 中导入：预热后冻结 GC，避免 worker 的 GC 触碰共享页"""
+    if preload_app:
+        import app
+
+        app.warm_up()
+        gc.freeze()
+
+
+def child_exit(server, worker):
+    """worker 退出后标记其 livesum 仪表为失效，避免在途请求数残留"""
+    if prometheus_multiproc_dir:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
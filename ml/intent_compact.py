@@ -0,0 +1,121 @@
+"""意图模型的紧凑导出格式：纯 NumPy 的 TF-IDF + 线性分类器推理。
+
+只依赖标准库与 NumPy，服务端（app.py）与训练端（ml/train.py 的导出与基准）共用
+同一实现，不需要导入 Flask 应用或 sklearn/mlflow。
+"""
+
+import json
+import os
+import re
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+COMPACT_MODEL_META = "intent_model.json"
+
+
+class CompactIntentModel:
+    """纯 NumPy 的 TF-IDF + 线性分类器推理，读取 ml/train.py --export_compact 的产物。
+
+    词表、IDF 与系数矩阵都是 .npy 文件并以 mmap 只读打开，多个 worker 进程共享同一份
+    页缓存；加载只需构建词表字典（毫秒级），不依赖 sklearn/scipy/pandas/mlflow。
+    分词、n-gram、sublinear_tf、范数与 softmax/OvR 的实现与 sklearn 一致，预测标签
+    相同，概率仅有浮点求和顺序带来的 1e-12 量级差异。
+    """
+
+    def __init__(
+        self,
+        meta: Dict[str, Any],
+        vocabulary: Dict[str, int],
+        idf: Any,
+        weights: Any,
+        intercept: Any,
+    ) -> None:
+        self.meta = meta
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights  # (n_features, n_classes)，按特征取行是连续内存
+        self.intercept = intercept
+        self.classes_ = np.array(meta["classes"])
+        self.lowercase = bool(meta["lowercase"])
+        self.token_pattern = re.compile(meta["token_pattern"])
+        self.min_n, self.max_n = meta["ngram_range"]
+        self.sublinear_tf = bool(meta["sublinear_tf"])
+        self.binary = bool(meta["binary"])
+        self.norm = meta["norm"]
+        self.proba = meta["proba"]
+
+    @staticmethod
+    def is_compact(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, COMPACT_MODEL_META))
+
+    @classmethod
+    def load(cls, path: str) -> "CompactIntentModel":
+        with open(os.path.join(path, COMPACT_MODEL_META), encoding="utf-8") as f:
+            meta = json.load(f)
+
+        def array(name: str) -> Any:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        # 词表以换行拼接的 UTF-8 字节保存（词元不含空白以外的分隔符）
+        terms = array("vocab").tobytes().decode("utf-8").split("\n")
+        vocabulary = {term: index for index, term in enumerate(terms)}
+        return cls(meta, vocabulary, array("idf"), array("coef"), array("intercept"))
+
+    def _terms(self, text: str) -> List[str]:
+        if self.lowercase:
+            text = text.lower()
+        tokens = self.token_pattern.findall(text)
+        if self.max_n == 1:
+            return tokens
+        grams = list(tokens) if self.min_n == 1 else []
+        for n in range(max(self.min_n, 2), self.max_n + 1):
+            grams.extend(
+                " ".join(tokens[i : i + n]) for i in range(len(tokens) - n + 1)
+            )
+        return grams
+
+    def decision_function(self, texts: Sequence[str]) -> Any:
+        scores = np.tile(self.intercept, (len(texts), 1)).astype(np.float64)
+        width = len(self.vocabulary)
+        # (文档, 词) 编码成一个整数，整批一次 unique 得到按文档、列排序的稀疏矩阵
+        keys = [
+            row * width + self.vocabulary[term]
+            for row, text in enumerate(texts)
+            for term in self._terms(text)
+            if term in self.vocabulary
+        ]
+        if not keys:
+            return scores
+        unique, counts = np.unique(np.array(keys, dtype=np.int64), return_counts=True)
+        rows, columns = np.divmod(unique, width)
+        values = np.ones(len(columns)) if self.binary else counts.astype(np.float64)
+        if self.sublinear_tf:
+            values = np.log(values) + 1
+        values *= self.idf[columns]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        lengths = np.diff(np.r_[starts, len(values)])
+        if self.norm == "l2":
+            values /= np.repeat(
+                np.sqrt(np.add.reduceat(values * values, starts)), lengths
+            )
+        elif self.norm == "l1":
+            values /= np.repeat(np.add.reduceat(np.abs(values), starts), lengths)
+        contributions = values[:, None] * self.weights[columns]
+        scores[rows[starts]] += np.add.reduceat(contributions, starts, axis=0)
+        return scores
+
+    def predict_proba(self, texts: Sequence[str]) -> Any:
+        scores = self.decision_function(texts)
+        if self.proba == "binary":
+            positive = 1 / (1 + np.exp(-scores[:, 0]))
+            return np.column_stack([1 - positive, positive])
+        if self.proba == "ovr":
+            probabilities = 1 / (1 + np.exp(-scores))
+            return probabilities / probabilities.sum(axis=1, keepdims=True)
+        scores -= scores.max(axis=1, keepdims=True)
+        np.exp(scores, out=scores)
+        return scores / scores.sum(axis=1, keepdims=True)
+
+    def predict(self, texts: Sequence[str]) -> Any:
+        return self.classes_[self.predict_proba(texts).argmax(axis=1)]
@@ -1,21 +1,45 @@
 import argparse
 import hashlib
+import itertools
 import json
+import math
+import multiprocessing
 import os
-import random
-from typing import List, Tuple
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Sequence,
+    Tuple,
+)
 
+import joblib
 import mlflow
 import mlflow.sklearn
 from mlflow.models.signature import infer_signature
 import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
+from scipy import sparse
+import sklearn
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.metrics import accuracy_score, f1_score
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 
+from intent_compact import COMPACT_MODEL_META, CompactIntentModel
+
 DEFAULT_LABELS = [
     "概念解释",
     "学习路径建议",
@@ -28,13 +52,42 @@ DEFAULT_LABELS = [
 ]
 
 
-def sha_short(content: str) -> str:
-    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:8]
+DATASET_SUFFIXES = (
+    ".csv",
+    ".csv.gz",
+    ".jsonl",
+    ".jsonl.gz",
+    ".json",
+    ".parquet",
+    ".arrow",
+    ".feather",
+)
+DEFAULT_COLUMNS = ("text", "label")
+# shards written by app.ChatLogCapture: the predicted intent is the (weak) label
+CHAT_LOG_PREFIX = "chatlog-"
+CHAT_LOG_COLUMNS = {"message": "text", "intent": "label"}
+DEFAULT_CHUNK_SIZE = 100_000
+TFIDF_DEFAULTS: Dict[str, Any] = {"max_features": 30_000, "ngram_range": (1, 2)}
+# --export_vectorizer feeds the app's semantic cache, which compares whole
+# questions: Chinese has no spaces, so it needs character n-grams, not words
+SEMANTIC_CACHE_PARAMS: Dict[str, Any] = {
+    "analyzer": "char_wb",
+    "ngram_range": (2, 3),
+    "sublinear_tf": True,
+    "max_features": 200_000,
+}
+# sweep parameters that change featurization; everything else goes to the classifier
+VECTORIZER_KEYS = ("max_features", "ngram_range", "min_df", "max_df", "sublinear_tf")
+FEATURE_CACHE_DIR = os.getenv(
+    "TRAIN_FEATURE_CACHE", os.path.join(os.path.dirname(__file__), ".cache", "features")
+)
+# least recently used entries are evicted once the cache grows past this size
+FEATURE_CACHE_MAX_BYTES = int(
+    float(os.getenv("TRAIN_FEATURE_CACHE_MAX_MB", 2048)) * 2**20
+)
 
 
 def autosample_dataset(n_per_label: int = 30, seed: int = 42) -> pd.DataFrame:
-    random.seed(seed)
-
     base_samples = {
         "概念解释": [
             "什么是交叉熵？通俗解释一下",
@@ -78,37 +131,158 @@ def autosample_dataset(n_per_label: int = 30, seed: int = 42) -> pd.DataFrame:
         ],
     }
 
-    rows: List[Tuple[str, str, str, str]] = []
-    suffix_options = [" 请详细一些", " 给个例子", " 有什么坑?", " Why?"]
+    # index 0 means "no suffix"; 1-3 are Chinese, which makes the row zh
+    suffix_options = np.array(["", " 请详细一些", " 给个例子", " 有什么坑?", " Why?"])
 
-    for label, seeds in base_samples.items():
-        for _ in range(n_per_label):
-            text = random.choice(seeds)
-            if random.random() < 0.3:
-                text = f"{text}{random.choice(suffix_options)}"
-            language = "zh" if any(ord(char) > 127 for char in text) else "en"
-            rows.append((text, label, "synthetic", language))
+    rng = np.random.default_rng(seed)
+    seeds = np.array(list(base_samples.values()))  # (labels, samples per label)
+    seed_is_zh = np.vectorize(lambda t: any(ord(char) > 127 for char in t))(seeds)
+    label_index = np.repeat(np.arange(len(seeds)), n_per_label)
+    picks = rng.integers(0, seeds.shape[1], len(label_index))
+    suffixes = np.where(
+        rng.random(len(label_index)) < 0.3,
+        rng.integers(1, len(suffix_options), len(label_index)),
+        0,
+    )
+    texts = np.char.add(seeds[label_index, picks], suffix_options[suffixes])
+    is_zh = seed_is_zh[label_index, picks] | ((suffixes > 0) & (suffixes < 4))
+    labels = np.array(list(base_samples))[label_index]
+    languages = np.where(is_zh, "zh", "en")
 
-    random.shuffle(rows)
-    dataframe = pd.DataFrame(rows, columns=["text", "label", "source", "lang"])
+    order = rng.permutation(len(labels))
+    dataframe = pd.DataFrame(
+        {
+            "text": texts[order],
+            "label": labels[order],
+            "source": "synthetic",
+            "lang": languages[order],
+        }
+    )
     return dataframe
 
 
-def load_dataset(path: str | None, autosample: bool) -> Tuple[pd.DataFrame, str]:
-    if autosample and not path:
+def dataset_files(path: str) -> List[str]:
+    """A dataset is a single file or a directory of shards (read in name order)."""
+    if not os.path.isdir(path):
+        return [path]
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if name.lower().endswith(DATASET_SUFFIXES)
+    ]
+
+
+def _read_chunks(
+    path: str,
+    columns: Sequence[str],
+    chunk_size: int,
+    dtypes: Dict[str, str],
+) -> Iterator[pd.DataFrame]:
+    lower = path.lower()
+    if lower.endswith((".csv", ".csv.gz")):
+        yield from pd.read_csv(
+            path, usecols=list(columns), dtype=dtypes, chunksize=chunk_size
+        )
+    elif lower.endswith((".jsonl", ".jsonl.gz", ".json")):
+        # JSON has no column projection on read; drop unused columns per chunk
+        for chunk in pd.read_json(path, lines=True, chunksize=chunk_size):
+            yield chunk[list(columns)].astype(dtypes)
+    elif lower.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunk_size, columns=list(columns)):
+            yield batch.to_pandas().astype(dtypes)
+    elif lower.endswith((".arrow", ".feather")):
+        import pyarrow.ipc as ipc
+
+        reader = ipc.open_file(path)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index).select(list(columns))
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas().astype(dtypes)
+    else:
+        raise ValueError(f"Unsupported dataset format: {path}")
+
+
+def iter_chat_log(
+    path: str,
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """Read one captured chat-log shard as text/label chunks.
+
+    Only closed ``.jsonl.gz`` shards reach here (the writer renames them from
+    ``.open`` on rotation); rows whose intent was below the confidence
+    threshold have a null label and are dropped by ``iter_dataset``.
+    """
+    for chunk in pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False):
+        for source in CHAT_LOG_COLUMNS:
+            if source not in chunk.columns:
+                chunk[source] = None
+        chunk = chunk.rename(columns=CHAT_LOG_COLUMNS)
+        extra = [c for c in columns if c not in chunk.columns]
+        if extra:
+            raise ValueError(f"Chat log {path} has no columns {extra}")
+        yield chunk[list(columns)].dropna().astype("str")
+
+
+def iter_dataset(
+    paths: Iterable[str],
+    columns: Sequence[str] = DEFAULT_COLUMNS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    dtypes: Dict[str, str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    """Stream CSV/JSONL/Parquet/Arrow files (or shard directories) in chunks.
+
+    Only ``columns`` are kept, rows missing text or label are dropped and every
+    chunk has the requested dtypes, so memory is bounded by ``chunk_size``
+    regardless of dataset size.
+    """
+    dtypes = dtypes or {column: "str" for column in columns}
+    for path in paths:
+        for file_path in dataset_files(path):
+            if os.path.basename(file_path).startswith(CHAT_LOG_PREFIX):
+                chunks = iter_chat_log(file_path, columns, chunk_size)
+            else:
+                chunks = _read_chunks(file_path, columns, chunk_size, dtypes)
+            for chunk in chunks:
+                chunk = chunk.dropna(
+                    subset=[c for c in DEFAULT_COLUMNS if c in columns]
+                )
+                if len(chunk):
+                    yield chunk.reset_index(drop=True)
+
+
+def update_fingerprint(hasher: Any, chunk: pd.DataFrame) -> None:
+    # one 64-bit hash per (text, label) row; order-sensitive, dtype-insensitive
+    rows = pd.util.hash_pandas_object(chunk[list(DEFAULT_COLUMNS)], index=False)
+    hasher.update(rows.to_numpy().tobytes())
+
+
+def dataset_fingerprint(
+    chunks: Iterable[pd.DataFrame], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> str:
+    """SHA-256 over every row's content, streamed chunk by chunk."""
+    hasher = hashlib.sha256()
+    for chunk in chunks:
+        for start in range(0, len(chunk), chunk_size):
+            update_fingerprint(hasher, chunk.iloc[start : start + chunk_size])
+    return hasher.hexdigest()
+
+
+def load_dataset(
+    path: str | None, autosample: bool, chat_logs: Sequence[str] = ()
+) -> Tuple[pd.DataFrame, str]:
+    if autosample and not path and not chat_logs:
         dataframe = autosample_dataset()
-        dataset_id = sha_short(f"autosample-{len(dataframe)}")
-        return dataframe, dataset_id
+        return dataframe, dataset_fingerprint([dataframe])
 
     frames = []
     if path:
-        extension = os.path.splitext(path)[1].lower()
-        if extension == ".csv":
-            frames.append(pd.read_csv(path))
-        elif extension in {".jsonl", ".json"}:
-            frames.append(pd.read_json(path, lines=True))
-        else:
-            raise ValueError(f"Unsupported dataset format: {extension}")
+        frames.extend(iter_dataset([path], columns=("text", "label")))
+    if chat_logs:
+        frames.extend(iter_dataset(chat_logs))
 
     # optional: merge built-in template
     template_csv = os.path.join(
@@ -132,34 +306,11 @@ def load_dataset(path: str | None, autosample: bool) -> Tuple[pd.DataFrame, str]
         {"text": str, "label": str}
     )
 
-    head_preview = dataframe.head(5).to_json(orient="records", force_ascii=False)
-    tail_preview = dataframe.tail(5).to_json(orient="records", force_ascii=False)
-    dataset_id = sha_short(f"{len(dataframe)}-{head_preview}-{tail_preview}")
-
-    return dataframe, dataset_id
-
-
-def train_and_log(
-    dataframe: pd.DataFrame, experiment_name: str, run_name: str, max_iter: int = 200
-) -> None:
-    features = dataframe["text"].astype(str).tolist()
-    labels = dataframe["label"].astype(str).tolist()
+    # full SHA-256 of the content: keys the feature cache, prefix names the run
+    return dataframe, dataset_fingerprint([dataframe])
 
-    X_train, X_test, y_train, y_test = train_test_split(
-        features,
-        labels,
-        test_size=0.2,
-        random_state=42,
-        stratify=labels,
-    )
-
-    pipeline = Pipeline(
-        [
-            ("tfidf", TfidfVectorizer(max_features=30_000, ngram_range=(1, 2))),
-            ("clf", LogisticRegression(max_iter=max_iter)),
-        ]
-    )
 
+def prepare_tracking(experiment_name: str) -> None:
     mlflow.set_experiment(experiment_name)
 
     # ensure clean run state
@@ -178,45 +329,753 @@ def train_and_log(
         mlflow.set_experiment(experiment_name)
         mlflow.set_tag("tracking", "local")
 
+
+def git_sha() -> str:
+    return (
+        os.getenv("GITHUB_SHA")
+        or os.popen("git rev-parse --short HEAD").read().strip()
+        or "unknown"
+    )
+
+
+def load_labels() -> List[str]:
+    labels_path = os.path.join(os.path.dirname(__file__), "configs", "labels.txt")
+    if os.path.exists(labels_path):
+        with open(labels_path, encoding="utf-8") as handle:
+            labels = [line.strip() for line in handle if line.strip()]
+        if labels:
+            return labels
+    return list(DEFAULT_LABELS)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def holdout_mask(texts: pd.Series, holdout: int) -> np.ndarray:
+    """Deterministic split by text hash: every pass sees the same holdout rows."""
+    hashes = pd.util.hash_pandas_object(texts, index=False).to_numpy()
+    return hashes % holdout == 0
+
+
+def train_streaming(
+    paths: Sequence[str],
+    experiment_name: str,
+    run_name: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    n_features: int = 2**20,
+    epochs: int = 1,
+    alpha: float = 1e-6,
+    holdout: int = 5,
+    vectorizer_path: str | None = None,
+    bench_rows: int = 256,
+) -> Dict[str, float]:
+    """Out-of-core training: hashed features + SGD ``partial_fit`` per chunk.
+
+    The hashing vectorizer is stateless, so nothing grows with the corpus and
+    peak memory stays at roughly one chunk of text plus its sparse matrix.
+    """
+    classes = np.array(load_labels())
+    vectorizer = HashingVectorizer(
+        n_features=n_features, ngram_range=(1, 2), alternate_sign=False
+    )
+    classifier = SGDClassifier(loss="log_loss", alpha=alpha, random_state=42)
+
+    hasher = hashlib.sha256()
+
+    def chunks(fingerprint: bool = False) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        for chunk in iter_dataset(paths, chunk_size=chunk_size):
+            if fingerprint:
+                update_fingerprint(hasher, chunk)
+            known = chunk["label"].isin(classes).to_numpy()
+            counts["dropped"] += int((~known).sum())
+            chunk = chunk[known]
+            yield chunk, holdout_mask(chunk["text"], holdout)
+
+    counts = {"dropped": 0, "train": 0, "holdout": 0}
+    started = time.perf_counter()
+    for epoch in range(epochs):
+        counts.update(dropped=0, train=0)
+        for chunk, test in chunks(fingerprint=epoch == 0):
+            train = chunk[~test]
+            if not len(train):
+                continue
+            classifier.partial_fit(
+                vectorizer.transform(train["text"]), train["label"], classes=classes
+            )
+            counts["train"] += len(train)
+    train_seconds = time.perf_counter() - started
+    if not counts["train"]:
+        raise ValueError("No training rows with known labels")
+
+    # evaluate on the hash holdout, keeping only label codes in memory
+    codes = {label: index for index, label in enumerate(classes)}
+    y_true: List[np.ndarray] = []
+    y_pred: List[np.ndarray] = []
+    for chunk, test in chunks():
+        held = chunk[test]
+        if not len(held):
+            continue
+        predicted = classifier.predict(vectorizer.transform(held["text"]))
+        y_true.append(held["label"].map(codes).to_numpy(dtype=np.int16))
+        y_pred.append(pd.Series(predicted).map(codes).to_numpy(dtype=np.int16))
+        counts["holdout"] += len(held)
+    true = np.concatenate(y_true) if y_true else np.zeros(0, dtype=np.int16)
+    pred = np.concatenate(y_pred) if y_pred else np.zeros(0, dtype=np.int16)
+
+    metrics = {
+        "accuracy": float(accuracy_score(true, pred)) if len(true) else 0.0,
+        "f1_macro": (
+            float(f1_score(true, pred, average="macro")) if len(true) else 0.0
+        ),
+        "rows_train": float(counts["train"]),
+        "rows_holdout": float(counts["holdout"]),
+        "rows_dropped": float(counts["dropped"]),
+        "train_seconds": train_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    prepare_tracking(experiment_name)
+    with mlflow.start_run(run_name=run_name, nested=True):
+        mlflow.log_params(
+            {
+                "model": "SGDClassifier",
+                "loss": "log_loss",
+                "alpha": alpha,
+                "hashing_n_features": n_features,
+                "hashing_ngram": "1-2",
+                "epochs": epochs,
+                "chunk_size": chunk_size,
+            }
+        )
+        mlflow.set_tag("git_sha", git_sha())
+        mlflow.set_tag("training", "streaming")
+        mlflow.set_tag("dataset_sha256", hasher.hexdigest())
+        mlflow.log_text("\n".join(classes), artifact_file="labels.txt")
+        mlflow.log_metrics(metrics)
+
+        if vectorizer_path:
+            # stateless like the model's features: no pass over the data needed
+            semantic = HashingVectorizer(
+                n_features=2**18,
+                analyzer=SEMANTIC_CACHE_PARAMS["analyzer"],
+                ngram_range=SEMANTIC_CACHE_PARAMS["ngram_range"],
+                alternate_sign=False,
+            )
+            joblib.dump(semantic, vectorizer_path)
+            mlflow.log_artifact(vectorizer_path, artifact_path="vectorizer")
+
+        pipeline = Pipeline([("hashing", vectorizer), ("clf", classifier)])
+        log_pipeline(pipeline, ["什么是交叉熵？"])
+        if bench_rows > 0:
+            sample = next(iter_dataset(paths, chunk_size=bench_rows), None)
+            texts = [] if sample is None else sample["text"].tolist()
+            serving = benchmark_models(pipeline, texts)
+            mlflow.log_metrics(serving)
+            metrics.update(serving)
+    return metrics
+
+
+class FeatureSet(NamedTuple):
+    vectorizer: TfidfVectorizer
+    X_train: sparse.csr_matrix
+    X_test: sparse.csr_matrix
+    y_train: np.ndarray
+    y_test: np.ndarray
+    cache_hit: bool
+
+
+def feature_cache_key(dataset_hash: str, vectorizer_params: Dict[str, Any]) -> str:
+    params = json.dumps(
+        {
+            "dataset": dataset_hash,
+            "vectorizer": vectorizer_params,
+            "split": {"test_size": 0.2, "random_state": 42},
+            # fitted vectorizers are pickled, and tokenization can change
+            "sklearn": sklearn.__version__,
+        },
+        sort_keys=True,
+        default=list,
+    )
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()[:16]
+
+
+def _save_csr(directory: str, name: str, matrix: sparse.csr_matrix) -> None:
+    for part in ("data", "indices", "indptr"):
+        np.save(os.path.join(directory, f"{name}_{part}.npy"), getattr(matrix, part))
+    np.save(os.path.join(directory, f"{name}_shape.npy"), np.array(matrix.shape))
+
+
+def _load_csr(directory: str, name: str) -> sparse.csr_matrix:
+    parts = [
+        np.load(os.path.join(directory, f"{name}_{part}.npy"), mmap_mode="r")
+        for part in ("data", "indices", "indptr")
+    ]
+    shape = tuple(np.load(os.path.join(directory, f"{name}_shape.npy")))
+    return sparse.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+def load_features(cache_dir: str, key: str) -> FeatureSet | None:
+    directory = os.path.join(cache_dir, key)
+    if not os.path.isdir(directory):
+        return None
+    os.utime(directory)  # mark as recently used for eviction
+    return FeatureSet(
+        vectorizer=joblib.load(os.path.join(directory, "vectorizer.joblib")),
+        X_train=_load_csr(directory, "X_train"),
+        X_test=_load_csr(directory, "X_test"),
+        y_train=np.load(os.path.join(directory, "y_train.npy"), mmap_mode="r"),
+        y_test=np.load(os.path.join(directory, "y_test.npy"), mmap_mode="r"),
+        cache_hit=True,
+    )
+
+
+def save_features(cache_dir: str, key: str, features: FeatureSet) -> None:
+    """Write into a temp dir and rename, so readers never see a partial entry."""
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{key}-", dir=cache_dir)
+    try:
+        joblib.dump(features.vectorizer, os.path.join(staging, "vectorizer.joblib"))
+        _save_csr(staging, "X_train", features.X_train)
+        _save_csr(staging, "X_test", features.X_test)
+        np.save(os.path.join(staging, "y_train.npy"), features.y_train)
+        np.save(os.path.join(staging, "y_test.npy"), features.y_test)
+        os.replace(staging, os.path.join(cache_dir, key))
+    except OSError:
+        # another process won the race (target exists) or the disk is full
+        shutil.rmtree(staging, ignore_errors=True)
+    evict_features(cache_dir, keep=key)
+
+
+def evict_features(
+    cache_dir: str, max_bytes: int = FEATURE_CACHE_MAX_BYTES, keep: str | None = None
+) -> List[str]:
+    """Delete least recently used entries until the cache fits in ``max_bytes``.
+
+    Entries still memory-mapped by another run stay readable until it closes
+    them, so eviction never breaks a concurrent trainer.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(path):
+            continue  # staging directories of in-progress writes
+        entries.append((os.path.getmtime(path), name, directory_size(path)))
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        evicted.append(name)
+    return evicted
+
+
+def featurize(
+    dataframe: pd.DataFrame,
+    dataset_hash: str,
+    vectorizer_params: Dict[str, Any] | None = None,
+    cache_dir: str | None = FEATURE_CACHE_DIR,
+) -> FeatureSet:
+    """Split and fit TF-IDF, reusing a cached result for the same data + params.
+
+    Cached matrices are memory-mapped, so repeated runs that only change the
+    classifier skip featurization and share pages with each other.
+    """
+    params = {**TFIDF_DEFAULTS, **(vectorizer_params or {})}
+    key = feature_cache_key(dataset_hash, params)
+    if cache_dir:
+        cached = load_features(cache_dir, key)
+        if cached is not None:
+            return cached
+
+    features = dataframe["text"].astype(str).tolist()
+    labels = dataframe["label"].astype(str).tolist()
+    X_train, X_test, y_train, y_test = train_test_split(
+        features,
+        labels,
+        test_size=0.2,
+        random_state=42,
+        stratify=labels,
+    )
+    vectorizer = TfidfVectorizer(**params)
+    result = FeatureSet(
+        vectorizer=vectorizer,
+        X_train=vectorizer.fit_transform(X_train),
+        X_test=vectorizer.transform(X_test),
+        y_train=np.array(y_train),
+        y_test=np.array(y_test),
+        cache_hit=False,
+    )
+    if cache_dir:
+        save_features(cache_dir, key, result)
+    return result
+
+
+def export_compact(pipeline: Pipeline, directory: str) -> Dict[str, Any]:
+    """Write a fitted TF-IDF + linear pipeline as plain .npy files for serving.
+
+    ``CompactIntentModel`` (ml/intent_compact.py, shared with app.py)
+    memory-maps the result and predicts with NumPy alone, so serving needs
+    neither sklearn, scipy, pandas nor mlflow.
+    """
+    vectorizer, classifier = pipeline.steps[0][1], pipeline.steps[-1][1]
+    if not isinstance(vectorizer, TfidfVectorizer):
+        raise ValueError("Compact export needs a TfidfVectorizer pipeline")
+    unsupported = {
+        "analyzer": vectorizer.analyzer != "word",
+        "tokenizer": vectorizer.tokenizer is not None,
+        "preprocessor": vectorizer.preprocessor is not None,
+        "stop_words": vectorizer.stop_words is not None,
+        "strip_accents": vectorizer.strip_accents is not None,
+        "use_idf": not vectorizer.use_idf,
+    }
+    if any(unsupported.values()):
+        names = ", ".join(name for name, bad in unsupported.items() if bad)
+        raise ValueError(f"Compact export does not support vectorizer {names}")
+
+    classes = [str(label) for label in classifier.classes_]
+    if len(classes) == 2:
+        proba = "binary"
+    elif isinstance(classifier, SGDClassifier) or (
+        getattr(classifier, "solver", None) == "liblinear"
+    ):
+        proba = "ovr"
+    else:
+        proba = "softmax"
+
+    terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.__getitem__)
+    if any("\n" in term for term in terms):
+        raise ValueError("Vocabulary terms must not contain newlines")
+    os.makedirs(directory, exist_ok=True)
+    arrays = {
+        "vocab": np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+        "idf": np.asarray(vectorizer.idf_, dtype=np.float64),
+        # feature-major so a document's columns are contiguous rows
+        "coef": np.ascontiguousarray(classifier.coef_.T, dtype=np.float64),
+        "intercept": np.asarray(classifier.intercept_, dtype=np.float64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+    meta = {
+        "format": 1,
+        "classes": classes,
+        "lowercase": vectorizer.lowercase,
+        "token_pattern": vectorizer.token_pattern,
+        "ngram_range": list(vectorizer.ngram_range),
+        "sublinear_tf": vectorizer.sublinear_tf,
+        "binary": vectorizer.binary,
+        "norm": vectorizer.norm,
+        "proba": proba,
+    }
+    with open(os.path.join(directory, COMPACT_MODEL_META), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def directory_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def benchmark_inference(
+    load: Callable[[], Any],
+    texts: List[str],
+    artifact_bytes: int,
+    batch_size: int = 64,
+    prefix: str = "serving",
+) -> Dict[str, float]:
+    """Serving cost of one model artifact: load time, latency, throughput, memory.
+
+    Peak memory is the traced heap while loading and predicting one batch;
+    memory-mapped arrays are shared page cache and intentionally not counted.
+    Latencies are measured afterwards without tracing overhead.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    model = load()
+    load_ms = (time.perf_counter() - started) * 1000
+    model.predict_proba(texts[:batch_size])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    single = []
+    for text in texts:
+        started = time.perf_counter()
+        model.predict_proba([text])
+        single.append(time.perf_counter() - started)
+    batched = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        started = time.perf_counter()
+        model.predict_proba(batch)
+        batched.append(time.perf_counter() - started)
+
+    single_p50, single_p99 = np.percentile(np.array(single) * 1000, [50, 99])
+    batch_p50, batch_p99 = np.percentile(np.array(batched) * 1000, [50, 99])
+    return {
+        f"{prefix}_load_ms": load_ms,
+        f"{prefix}_single_p50_ms": float(single_p50),
+        f"{prefix}_single_p99_ms": float(single_p99),
+        f"{prefix}_batch{batch_size}_p50_ms": float(batch_p50),
+        f"{prefix}_batch{batch_size}_p99_ms": float(batch_p99),
+        f"{prefix}_throughput_rps": len(texts) / sum(batched),
+        f"{prefix}_artifact_mb": artifact_bytes / 2**20,
+        f"{prefix}_peak_memory_mb": peak / 2**20,
+    }
+
+
+def benchmark_models(
+    pipeline: Pipeline,
+    texts: List[str],
+    compact_path: str | None = None,
+) -> Dict[str, float]:
+    """Benchmark the sklearn pipeline and, if exported, its compact twin."""
+    if not texts:
+        return {}
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pickled = os.path.join(tmp, "model.joblib")
+        joblib.dump(pipeline, pickled)
+        metrics.update(
+            benchmark_inference(
+                lambda: joblib.load(pickled),
+                texts,
+                directory_size(pickled),
+                prefix="serving_sklearn",
+            )
+        )
+    if compact_path:
+        metrics.update(
+            benchmark_inference(
+                lambda: CompactIntentModel.load(compact_path),
+                texts,
+                directory_size(compact_path),
+                prefix="serving_compact",
+            )
+        )
+    return metrics
+
+
+def benchmark_texts(dataframe: pd.DataFrame, rows: int) -> List[str]:
+    if rows <= 0 or dataframe.empty:
+        return []
+    sample = dataframe["text"].sample(
+        n=rows, replace=len(dataframe) < rows, random_state=0
+    )
+    return sample.astype(str).tolist()
+
+
+def log_pipeline(pipeline: Pipeline, examples: List[str]) -> None:
+    # add input_example and signature for better model registry
+    input_example = pd.DataFrame({"text": examples})
+    signature = infer_signature(input_example, pipeline.predict(input_example["text"]))
+    mlflow.sklearn.log_model(
+        pipeline,
+        artifact_path="model",
+        input_example=input_example,
+        signature=signature,
+    )
+
+
+def train_and_log(
+    dataframe: pd.DataFrame,
+    experiment_name: str,
+    run_name: str,
+    max_iter: int = 200,
+    vectorizer_path: str | None = None,
+    dataset_hash: str | None = None,
+    cache_dir: str | None = FEATURE_CACHE_DIR,
+    compact_path: str | None = None,
+    bench_rows: int = 256,
+) -> None:
+    dataset_hash = dataset_hash or dataset_fingerprint([dataframe])
+    started = time.perf_counter()
+    features = featurize(dataframe, dataset_hash, cache_dir=cache_dir)
+    featurize_seconds = time.perf_counter() - started
+
+    prepare_tracking(experiment_name)
+
     with mlflow.start_run(run_name=run_name, nested=True):
         mlflow.log_params(
             {
                 "model": "LogisticRegression",
-                "tfidf_max_features": 30_000,
-                "tfidf_ngram": "1-2",
+                "tfidf_max_features": TFIDF_DEFAULTS["max_features"],
+                "tfidf_ngram": "%d-%d" % TFIDF_DEFAULTS["ngram_range"],
                 "max_iter": max_iter,
             }
         )
 
-        git_sha = (
-            os.getenv("GITHUB_SHA")
-            or os.popen("git rev-parse --short HEAD").read().strip()
-            or "unknown"
-        )
-        mlflow.set_tag("git_sha", git_sha)
+        mlflow.set_tag("git_sha", git_sha())
+        mlflow.set_tag("dataset_sha256", dataset_hash)
+        mlflow.set_tag("feature_cache", "hit" if features.cache_hit else "miss")
 
-        unique_labels = sorted(set(labels))
+        unique_labels = sorted(set(dataframe["label"].astype(str)))
         mlflow.log_text(
             "\n".join(unique_labels),
             artifact_file="labels.txt",
         )
 
-        pipeline.fit(X_train, y_train)
-        predictions = pipeline.predict(X_test)
-        accuracy = accuracy_score(y_test, predictions)
-        f1_macro = f1_score(y_test, predictions, average="macro")
-        mlflow.log_metrics({"accuracy": accuracy, "f1_macro": f1_macro})
-
-        # add input_example and signature for better model registry
-        input_example = pd.DataFrame({"text": X_test[:3]})
-        signature = infer_signature(input_example, predictions[:3])
-        mlflow.sklearn.log_model(
-            pipeline,
-            artifact_path="model",
-            input_example=input_example,
-            signature=signature,
+        classifier = LogisticRegression(max_iter=max_iter)
+        classifier.fit(features.X_train, features.y_train)
+        predictions = classifier.predict(features.X_test)
+        accuracy = accuracy_score(features.y_test, predictions)
+        f1_macro = f1_score(features.y_test, predictions, average="macro")
+        mlflow.log_metrics(
+            {
+                "accuracy": accuracy,
+                "f1_macro": f1_macro,
+                "featurize_seconds": featurize_seconds,
+            }
+        )
+
+        # both steps are already fitted; the pipeline only bundles them
+        pipeline = Pipeline([("tfidf", features.vectorizer), ("clf", classifier)])
+
+        # a character n-gram TF-IDF for the app's semantic cache
+        if vectorizer_path:
+            semantic = TfidfVectorizer(**SEMANTIC_CACHE_PARAMS)
+            joblib.dump(semantic.fit(dataframe["text"].astype(str)), vectorizer_path)
+            mlflow.log_artifact(vectorizer_path, artifact_path="vectorizer")
+
+        log_pipeline(pipeline, dataframe["text"].astype(str).head(3).tolist())
+        if compact_path:
+            export_compact(pipeline, compact_path)
+            mlflow.log_artifacts(compact_path, artifact_path="compact")
+        mlflow.log_metrics(
+            benchmark_models(
+                pipeline, benchmark_texts(dataframe, bench_rows), compact_path
+            )
+        )
+
+
+def expand_space(
+    space: Dict[str, Any], n_trials: int | None = None, seed: int = 42
+) -> List[Dict[str, Any]]:
+    """Grid over ``space`` (lists are choices, scalars fixed), sampled down to n_trials."""
+    keys = sorted(space)
+    choices = [space[k] if isinstance(space[k], list) else [space[k]] for k in keys]
+    grid = [dict(zip(keys, combo)) for combo in itertools.product(*choices)]
+    if n_trials and n_trials < len(grid):
+        picks = np.random.default_rng(seed).choice(len(grid), n_trials, replace=False)
+        grid = [grid[index] for index in sorted(picks)]
+    return grid
+
+
+def split_trial(trial: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    vectorizer_params = {
+        key: tuple(value) if key == "ngram_range" else value
+        for key, value in trial.items()
+        if key in VECTORIZER_KEYS
+    }
+    classifier_params = {
+        key: value for key, value in trial.items() if key not in VECTORIZER_KEYS
+    }
+    return {**TFIDF_DEFAULTS, **vectorizer_params}, classifier_params
+
+
+def _featurize_task(
+    data_path: str,
+    dataset_hash: str,
+    vectorizer_params: Dict[str, Any],
+    cache_dir: str,
+) -> str:
+    # workers read the staged text/label file rather than unpickling a frame
+    dataframe = pd.read_parquet(data_path, columns=list(DEFAULT_COLUMNS))
+    featurize(dataframe, dataset_hash, vectorizer_params, cache_dir=cache_dir)
+    return feature_cache_key(dataset_hash, vectorizer_params)
+
+
+def run_trial(
+    cache_dir: str, key: str, classifier_params: Dict[str, Any], fraction: float
+) -> Dict[str, Any]:
+    """Fit one classifier on a prefix of the (already shuffled) training split.
+
+    Features come from the memory-mapped cache, so concurrent trials on the same
+    vectorizer settings share one copy of the matrices through the page cache.
+    """
+    features = load_features(cache_dir, key)
+    if features is None:
+        raise RuntimeError(f"feature cache entry {key} is missing")
+    total = features.X_train.shape[0]
+    rows = min(total, max(int(total * fraction), 1_000))
+    classifier = LogisticRegression(**{"max_iter": 200, **classifier_params})
+    started = time.perf_counter()
+    classifier.fit(features.X_train[:rows], features.y_train[:rows])
+    fit_seconds = time.perf_counter() - started
+    predictions = classifier.predict(features.X_test)
+    return {
+        "accuracy": float(accuracy_score(features.y_test, predictions)),
+        "f1_macro": float(f1_score(features.y_test, predictions, average="macro")),
+        "fit_seconds": fit_seconds,
+        "train_rows": rows,
+        # only the final rung's models are worth shipping back to the parent
+        "classifier": classifier if rows == total else None,
+    }
+
+
+def train_sweep(
+    dataframe: pd.DataFrame,
+    experiment_name: str,
+    run_name: str,
+    space: Dict[str, Any],
+    n_trials: int | None = None,
+    workers: int | None = None,
+    eta: int = 3,
+    min_fraction: float = 0.1,
+    dataset_hash: str | None = None,
+    cache_dir: str | None = FEATURE_CACHE_DIR,
+    compact_path: str | None = None,
+    bench_rows: int = 256,
+) -> Dict[str, Any]:
+    """Parallel sweep with successive halving, one MLflow child run per trial.
+
+    Every trial first trains on ``min_fraction`` of the training rows; after
+    each rung only the best ``1/eta`` move on to ``eta`` times more data, and
+    the rest are logged as pruned. Featurization happens once per distinct
+    vectorizer setting and is shared through the feature cache.
+    """
+    dataset_hash = dataset_hash or dataset_fingerprint([dataframe])
+    trials = expand_space(space, n_trials)
+    settings = [split_trial(trial) for trial in trials]
+    fractions = [1.0]
+    while fractions[0] / eta >= min_fraction:
+        fractions.insert(0, fractions[0] / eta)
+    workers = workers or os.cpu_count() or 1
+
+    prepare_tracking(experiment_name)
+    results: Dict[int, Dict[str, Any]] = {}
+
+    def log_trial(index: int, status: str) -> None:
+        result = results[index]
+        with mlflow.start_run(run_name=f"trial-{index:03d}", nested=True):
+            mlflow.log_params(trials[index])
+            mlflow.set_tag("status", status)
+            mlflow.set_tag("rung", str(result["rung"]))
+            mlflow.log_metrics(
+                {
+                    name: result[name]
+                    for name in ("accuracy", "f1_macro", "fit_seconds", "train_rows")
+                }
+            )
+
+    started = time.perf_counter()
+    # spawn: the parent holds MLflow clients and threads that must not be forked
+    context = multiprocessing.get_context("spawn")
+    # the scratch dir (staged data, features without a cache) outlives the pool
+    # and is removed even when a trial fails
+    with tempfile.TemporaryDirectory(prefix="sweep-") as scratch, mlflow.start_run(
+        run_name=run_name, nested=True
+    ), ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        cache_dir = cache_dir or os.path.join(scratch, "features")
+        mlflow.log_params(
+            {
+                "mode": "sweep",
+                "trials": len(trials),
+                "workers": workers,
+                "eta": eta,
+                "rungs": len(fractions),
+            }
+        )
+        mlflow.set_tag("git_sha", git_sha())
+        mlflow.set_tag("dataset_sha256", dataset_hash)
+        mlflow.log_dict(space, "sweep_space.json")
+
+        distinct = {json.dumps(v, sort_keys=True): v for v, _ in settings}
+        keys = {
+            name: feature_cache_key(dataset_hash, params)
+            for name, params in distinct.items()
+        }
+        missing = [
+            params
+            for name, params in distinct.items()
+            if not os.path.isdir(os.path.join(cache_dir, keys[name]))
+        ]
+        if missing:
+            # workers read this file instead of each unpickling the whole frame
+            staged = os.path.join(scratch, "dataset.parquet")
+            dataframe[list(DEFAULT_COLUMNS)].astype(str).to_parquet(staged, index=False)
+            tasks = [
+                pool.submit(_featurize_task, staged, dataset_hash, params, cache_dir)
+                for params in missing
+            ]
+            for task in tasks:
+                task.result()
+        trial_keys = [keys[json.dumps(v, sort_keys=True)] for v, _ in settings]
+
+        alive = list(range(len(trials)))
+        rungs: List[Dict[str, Any]] = []
+        for rung, fraction in enumerate(fractions):
+            futures = {
+                pool.submit(
+                    run_trial,
+                    cache_dir,
+                    trial_keys[index],
+                    settings[index][1],
+                    fraction,
+                ): index
+                for index in alive
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = {**future.result(), "rung": rung}
+            alive.sort(key=lambda index: results[index]["f1_macro"], reverse=True)
+            rungs.append(
+                {
+                    "fraction": fraction,
+                    "f1_macro": {index: results[index]["f1_macro"] for index in alive},
+                }
+            )
+            if fraction < 1.0:
+                survivors = max(1, math.ceil(len(alive) / eta))
+                for index in alive[survivors:]:
+                    log_trial(index, "pruned")
+                alive = alive[:survivors]
+        for index in alive:
+            log_trial(index, "completed")
+
+        best = alive[0]
+        mlflow.set_tag("best_trial", f"trial-{best:03d}")
+        features = load_features(cache_dir, trial_keys[best])
+        assert features is not None
+        pipeline = Pipeline(
+            [("tfidf", features.vectorizer), ("clf", results[best]["classifier"])]
+        )
+        mlflow.log_params({f"best_{k}": v for k, v in trials[best].items()})
+        mlflow.log_metrics(
+            {
+                "best_accuracy": results[best]["accuracy"],
+                "best_f1_macro": results[best]["f1_macro"],
+                "sweep_seconds": time.perf_counter() - started,
+            }
+        )
+        log_pipeline(pipeline, dataframe["text"].astype(str).head(3).tolist())
+        if compact_path:
+            export_compact(pipeline, compact_path)
+            mlflow.log_artifacts(compact_path, artifact_path="compact")
+        mlflow.log_metrics(
+            benchmark_models(
+                pipeline, benchmark_texts(dataframe, bench_rows), compact_path
+            )
         )
 
+    return {
+        "best_trial": best,
+        "best_params": trials[best],
+        "f1_macro": results[best]["f1_macro"],
+        "accuracy": results[best]["accuracy"],
+        "pruned": len(trials) - len(alive),
+        "rungs": rungs,
+    }
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -224,30 +1083,155 @@ def main() -> None:
         "--data",
         type=str,
         default=None,
-        help="Path to CSV/JSONL with columns text,label",
+        help="Path to CSV/JSONL/Parquet/Arrow (or a directory of shards) "
+        "with columns text,label",
     )
     parser.add_argument("--exp", type=str, default="ai-learning-intent")
     parser.add_argument("--run", type=str, default=None)
     parser.add_argument("--autosample", action="store_true")
+    parser.add_argument(
+        "--chat_logs",
+        action="append",
+        default=[],
+        help="Directory of captured chat-log shards (CHAT_LOG_DIR) to train on; "
+        "repeatable",
+    )
     parser.add_argument("--max_iter", type=int, default=200)
+    parser.add_argument(
+        "--export_vectorizer",
+        type=str,
+        default=None,
+        help="Write a character n-gram vectorizer (joblib) for "
+        "SEMANTIC_CACHE_VECTORIZER",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Out-of-core training (hashing vectorizer + SGD partial_fit)",
+    )
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--n_features", type=int, default=2**20)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument(
+        "--feature_cache",
+        type=str,
+        default=FEATURE_CACHE_DIR,
+        help="Directory of cached TF-IDF features keyed on dataset hash + params",
+    )
+    parser.add_argument("--no_feature_cache", action="store_true")
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        default=None,
+        help="Search space as a JSON file or inline JSON, e.g. "
+        '\'{"C": [0.1, 1, 10], "ngram_range": [[1, 1], [1, 2]]}\'',
+    )
+    parser.add_argument("--trials", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--eta", type=int, default=3, help="Successive halving keeps 1/eta per rung"
+    )
+    parser.add_argument("--min_fraction", type=float, default=0.1)
+    parser.add_argument(
+        "--export_compact",
+        type=str,
+        default=None,
+        help="Write the fitted model as .npy files for INTENT_MODEL_URI (no sklearn)",
+    )
+    parser.add_argument(
+        "--bench_rows",
+        type=int,
+        default=256,
+        help="Texts used for the inference benchmark logged per model (0 disables)",
+    )
+    parser.add_argument(
+        "--from_model",
+        type=str,
+        default=None,
+        help="Only convert an existing MLflow model URI with --export_compact",
+    )
     arguments = parser.parse_args()
 
-    dataframe, dataset_id = load_dataset(arguments.data, arguments.autosample)
+    if arguments.from_model:
+        if not arguments.export_compact:
+            parser.error("--from_model requires --export_compact")
+        meta = export_compact(
+            mlflow.sklearn.load_model(arguments.from_model), arguments.export_compact
+        )
+        print(json.dumps(meta, indent=2, ensure_ascii=False))
+        return
 
-    base_name = (
-        "autosample" if arguments.autosample else os.path.basename(arguments.data)
+    if arguments.streaming:
+        paths = [arguments.data] if arguments.data else []
+        if not paths + arguments.chat_logs:
+            parser.error("--streaming requires --data or --chat_logs")
+        if arguments.export_compact:
+            parser.error("--export_compact needs a TF-IDF model, not --streaming")
+        base_name = os.path.basename(os.path.normpath((paths + arguments.chat_logs)[0]))
+        metrics = train_streaming(
+            paths + arguments.chat_logs,
+            arguments.exp,
+            arguments.run or f"intent_{base_name}_streaming",
+            chunk_size=arguments.chunk_size,
+            n_features=arguments.n_features,
+            epochs=arguments.epochs,
+            vectorizer_path=arguments.export_vectorizer,
+            bench_rows=arguments.bench_rows,
+        )
+        print(json.dumps(metrics, indent=2))
+        return
+
+    dataframe, dataset_hash = load_dataset(
+        arguments.data, arguments.autosample, arguments.chat_logs
     )
+    dataset_id = dataset_hash[:8]
+
+    if arguments.autosample:
+        base_name = "autosample"
+    elif arguments.data:
+        base_name = os.path.basename(arguments.data)
+    else:
+        base_name = "chatlogs"
     run_name = arguments.run or f"intent_{base_name}_{dataset_id}"
 
     # record dataset info
     mlflow.set_tag("dataset_version", dataset_id)
     mlflow.set_tag("dataset_rows", str(len(dataframe)))
 
+    cache_dir = None if arguments.no_feature_cache else arguments.feature_cache
+    if arguments.sweep:
+        if os.path.exists(arguments.sweep):
+            with open(arguments.sweep, encoding="utf-8") as handle:
+                space = json.load(handle)
+        else:
+            space = json.loads(arguments.sweep)
+        summary = train_sweep(
+            dataframe,
+            arguments.exp,
+            arguments.run or f"sweep_{base_name}_{dataset_id}",
+            space,
+            n_trials=arguments.trials,
+            workers=arguments.workers,
+            eta=arguments.eta,
+            min_fraction=arguments.min_fraction,
+            dataset_hash=dataset_hash,
+            cache_dir=cache_dir,
+            compact_path=arguments.export_compact,
+            bench_rows=arguments.bench_rows,
+        )
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+        return
+
     train_and_log(
         dataframe,
         arguments.exp,
         run_name,
         max_iter=arguments.max_iter,
+        vectorizer_path=arguments.export_vectorizer,
+        dataset_hash=dataset_hash,
+        cache_dir=cache_dir,
+        compact_path=arguments.export_compact,
+        bench_rows=arguments.bench_rows,
     )
 
 
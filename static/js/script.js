@@ -70,48 +70,20 @@ class AILearningAssistant {
         const assistantDiv = this.createAssistantMessageContainer();
         
         try {
-            const controller = new AbortController();
-            const timeoutId = setTimeout(() => controller.abort(), 60000);
-
-            const response = await fetch('/api/chat/stream', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    message: message,
-                    max_tokens: document.getElementById('maxTokens').value,
-                    temperature: this.temperatureSlider.value
-                }),
-                signal: controller.signal
+            const body = JSON.stringify({
+                message: message,
+                max_tokens: document.getElementById('maxTokens').value,
+                temperature: this.temperatureSlider.value
             });
-
-            clearTimeout(timeoutId);
-
-            if (!response.ok || !response.body) {
-                const data = await response.json().catch(() => ({}));
-                throw new Error(data.error || 'Request failed');
-            }
-
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder('utf-8');
-            let buffer = '';
-
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                buffer += decoder.decode(value, { stream: true });
-                let idx;
-                while ((idx = buffer.indexOf('\n\n')) !== -1) {
-                    const chunk = buffer.slice(0, idx);
-                    buffer = buffer.slice(idx + 2);
-                    if (chunk.startsWith('data:')) {
-                        const jsonStr = chunk.replace(/^data:\s*/, '');
-                        try {
-                            const obj = JSON.parse(jsonStr);
-                            if (obj.delta) {
-                                this.appendToAssistantMessage(assistantDiv, obj.delta);
-                            }
-                        } catch (e) { /* ignore parse errors */ }
-                    }
+            const state = { lastEventId: null, finished: false };
+            // 移动网络断线时带 Last-Event-ID 重连，服务端补发错过的内容而不是重新生成
+            for (let attempt = 0; !state.finished; attempt++) {
+                try {
+                    await this.readStream(body, state, assistantDiv);
+                } catch (error) {
+                    const resumable = state.lastEventId && !error.fatal && error.name !== 'AbortError';
+                    if (!resumable || attempt >= 3) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
                 }
             }
         } catch (error) {
@@ -136,6 +108,82 @@ class AILearningAssistant {
         }
     }
     
+    async readStream(body, state, assistantDiv) {
+        const controller = new AbortController();
+        const timeoutId = setTimeout(() => controller.abort(), 60000);
+        const headers = { 'Content-Type': 'application/json' };
+        if (state.lastEventId) {
+            headers['Last-Event-ID'] = state.lastEventId;
+        }
+
+        const response = await fetch('/api/chat/stream', {
+            method: 'POST',
+            headers: headers,
+            body: body,
+            signal: controller.signal
+        });
+
+        clearTimeout(timeoutId);
+
+        if (!response.ok || !response.body) {
+            const data = await response.json().catch(() => ({}));
+            const error = new Error(data.error || 'Request failed');
+            error.fatal = true;
+            throw error;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let idx;
+            while ((idx = buffer.indexOf('\n\n')) !== -1) {
+                const chunk = buffer.slice(0, idx);
+                buffer = buffer.slice(idx + 2);
+                let event = 'message';
+                let eventId = null;
+                let data = '';
+                for (const line of chunk.split('\n')) {
+                    if (line.startsWith('id:')) {
+                        eventId = line.slice(3).trim();
+                    } else if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        data = line.replace(/^data:\s*/, '');
+                    }
+                }
+                if (event === 'end') {
+                    state.finished = true;
+                    return;
+                }
+                let obj = {};
+                try {
+                    obj = data ? JSON.parse(data) : {};
+                } catch (e) { /* ignore parse errors */ }
+                if (event === 'error') {
+                    const error = new Error(obj.error || 'Stream failed');
+                    error.fatal = true;
+                    throw error;
+                }
+                if (event === 'start' && obj.stream_id && !state.lastEventId) {
+                    state.lastEventId = `${obj.stream_id}:0`;
+                }
+                if (obj.delta) {
+                    this.appendToAssistantMessage(assistantDiv, obj.delta);
+                }
+                if (eventId) {
+                    state.lastEventId = eventId;
+                }
+            }
+        }
+        // 连接在 end 事件之前关闭：交给调用方用 Last-Event-ID 重连
+        throw new Error('stream interrupted');
+    }
+
     addMessage(content, sender) {
         if (this.messagesContainer.querySelector('.welcome-message')) {
             this.messagesContainer.innerHTML = '';